@@ -1,33 +1,126 @@
 import asyncio
-import functools
+import collections
 import logging
+import logging.handlers
+import os
 import random
 import signal
 import string
 import uuid
+from queue import SimpleQueue
 
 import attr
 
+try:
+    import uvloop
+except ImportError:  # optional, installed with the `uvloop` extra; unavailable on Windows
+    uvloop = None
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s,%(msecs)d %(levelname)s: %(message)s",
-    datefmt="%H:%M:%S",
-)
 
+log = logging.getLogger(__name__)
 
-@attr.s
+HOSTNAME_SUFFIX = ".example.net"
+
+HOST_ID_CHARS = string.ascii_lowercase + string.digits
+# maps every possible random byte onto the host id alphabet
+_HOST_ID_TABLE = bytes(HOST_ID_CHARS.encode()[b % len(HOST_ID_CHARS)] for b in range(256))
+# number of message and host id pairs generated per refill of publish's id pool
+ID_POOL_SIZE = 256
+# number of long-lived consumer tasks pulling messages off the queue
+WORKERS = 8
+# messages held in the queue before the publisher has to wait for consumers
+QUEUE_MAXSIZE = 1024
+
+
+@attr.s(slots=True, repr=False)
 class PubSubMessage:
     instance_name = attr.ib()
     message_id    = attr.ib(repr=False)
-    hostname      = attr.ib(repr=False, init=False)
+    hostname      = attr.ib(repr=False)
     restarted = attr.ib(repr=False, default=False)
     saved = attr.ib(repr=False, default=False)
     acked = attr.ib(repr=False, default=False)
     extended_cnt = attr.ib(repr=False, default=0)
 
-    def __attrs_post_init__(self):
-        self.hostname = f"{self.instance_name}.example.net"
+    def __repr__(self):
+        # hand-written since it runs for nearly every log record; matches the attrs-generated repr
+        return f"PubSubMessage(instance_name={self.instance_name!r})"
+
+    def ack(self):
+        """Acknowledge the message once work on it is complete."""
+        self.acked = True
+        log.info("Done. Acked %s", self)
+
+
+class MessageQueue:
+    """
+    Bounded FIFO queue of messages shared by a publisher and a pool of consumers.
+
+    A lighter stand-in for `asyncio.Queue`: items live in a deque, and a future is
+    only created when a consumer has to wait on an empty queue (or the publisher
+    on a full one). Waiters are kept in FIFO order, and each put or get wakes
+    exactly one of them.
+
+    args:
+        maxsize (int): number of messages held before `put` waits for room.
+            Zero or less means the queue is unbounded.
+    """
+
+    def __init__(self, maxsize=0):
+        self._maxsize = maxsize
+        self._dq = collections.deque()
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+
+    def _wakeup_next(self, waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def _wait(self, waiters, blocked):
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            waiter.cancel()
+            try:
+                waiters.remove(waiter)
+            except ValueError:
+                pass
+            # pass on a wakeup this waiter received but can no longer use
+            if not blocked() and not waiter.cancelled():
+                self._wakeup_next(waiters)
+            raise
+
+    def qsize(self):
+        return len(self._dq)
+
+    def empty(self):
+        return not self._dq
+
+    def full(self):
+        return 0 < self._maxsize <= len(self._dq)
+
+    def put_nowait(self, msg):
+        if self.full():
+            raise asyncio.QueueFull
+        self._dq.append(msg)
+        self._wakeup_next(self._getters)
+
+    async def put(self, msg):
+        while self.full():
+            await self._wait(self._putters, self.full)
+        self.put_nowait(msg)
+
+    async def get(self):
+        while not self._dq:
+            await self._wait(self._getters, self.empty)
+        msg = self._dq.popleft()
+        self._wakeup_next(self._putters)
+        return msg
 
 
 async def restart_host(msg):
@@ -40,7 +133,7 @@ async def restart_host(msg):
     # simulates variable time it takes to restart a host
     await asyncio.sleep(random.random())
     msg.restarted = True
-    logging.info(f"Restarted {msg.hostname}")
+    log.info("Restarted %s", msg.hostname)
 
 
 async def save(msg):
@@ -53,23 +146,7 @@ async def save(msg):
     # simulates variable time it takes to persist a record to a database
     await asyncio.sleep(random.random())
     msg.saved = True
-    logging.info(f"Saved {msg} into database")
-
-
-async def cleanup(msg):
-    """
-    Cleanup tasks related to completing work on a message.
-
-    args:
-        msg (PubSubMessage): consumed event message that is done being
-            processed.
-        fut (asyncio.Future): future provided by the callback.
-    """
-    # blocks rest of the coroutine until `event.set` is called
-    await event.wait()
-    await asyncio.sleep(random.random())
-    msg.acked = True
-    logging.info(f"Done. Acked {msg}")
+    log.info("Saved %s into database", msg)
 
 
 async def extend(msg, event):
@@ -82,7 +159,7 @@ async def extend(msg, event):
     """
     while not event.is_set():
         msg.extended_cnt += 1
-        logging.info(f"Extended deadline by 3 seconds for {msg}")
+        log.info("Extended deadline by 3 seconds for %s", msg)
         await asyncio.sleep(2)
 
 
@@ -95,24 +172,47 @@ async def handle_message(msg):
     """
     event = asyncio.Event()
     asyncio.create_task(extend(msg, event))
-    await asyncio.gather(save(msg), restart_host(msg))
-    event.set()
+    # restarting a host and saving an obj to the database using that host are treated as separate, independent
+    # processes. if they were dependent you would await these coroutines sequentially
+    try:
+        await asyncio.gather(save(msg), restart_host(msg))
+        msg.ack()
+    finally:
+        # stop extending the deadline even if processing failed or was cancelled
+        event.set()
 
 
 async def consume(queue):
     """
     Simulates a consumer that restarts a host when it receives a message
 
+    Several consumers run side by side, each handling one message at a time.
+
     args:
-        queue (asyncio.Queue): Queue to consume messages from.
+        queue (MessageQueue): Queue to consume messages from.
     """
     while True:
         msg = await queue.get()
-        logging.info(f"Consumed {msg}")
+        log.info("Consumed %s", msg)
+        try:
+            await handle_message(msg)
+        except Exception:
+            # keep the worker alive for the next message
+            log.exception("Error handling %s", msg)
+
+
+def _generate_uuids(n):
+    return [uuid.uuid4().hex for _ in range(n)]
 
-        # restarting a host and saving an obj to the database using that host are treated as separate, independent
-        # processes. if they were dependent you would await these coroutines sequentially
-        asyncio.create_task(handle_message(msg))
+
+def _generate_host_ids(n):
+    # a whole batch is one urandom call plus one translate
+    ids = os.urandom(4 * n).translate(_HOST_ID_TABLE).decode()
+    return [ids[i:i + 4] for i in range(0, len(ids), 4)]
+
+
+def _generate_ids(n):
+    return list(zip(_generate_uuids(n), _generate_host_ids(n)))
 
 
 async def publish(queue):
@@ -120,55 +220,100 @@ async def publish(queue):
     Simulates an external publisher of messages.
 
     args:
-        queue (asyncio.Queue): Queue to publish messages to.
+        queue (MessageQueue): Queue to publish messages to.
     """
-    choices = string.ascii_lowercase + string.digits
+    loop = asyncio.get_running_loop()
+    # (msg_id, host_id) pairs, local so concurrent publishers cannot drain each other's pool
+    id_pool = collections.deque()
+    # bind the per-message lookups once; locals are cheaper than module attributes in the loop
+    next_ids = id_pool.popleft
+    sleep, rand = asyncio.sleep, random.random
 
     while True:
-        msg_id = str(uuid.uuid4())
-        host_id = "".join(random.choices(choices, k=4))
-        instance_name = f"cattle-{host_id}"
-        msg = PubSubMessage(message_id=msg_id, instance_name=instance_name)
-        # publish an item
-        asyncio.create_task(queue.put(msg))
-        logging.debug(f"Published message {msg}")
+        # ids are generated in batches off the event loop and handed out one at a time
+        if not id_pool:
+            id_pool.extend(await loop.run_in_executor(None, _generate_ids, ID_POOL_SIZE))
+        msg_id, host_id = next_ids()
+        instance_name = "cattle-" + host_id
+        msg = PubSubMessage(
+            message_id=msg_id, instance_name=instance_name, hostname=instance_name + HOSTNAME_SUFFIX
+        )
+        # publish an item, only suspending to wait for room if consumers have fallen behind
+        if queue.full():
+            await queue.put(msg)
+        else:
+            queue.put_nowait(msg)
+        log.debug("Published message %s", msg)
         # simulate randomness of publishing messages
-        await asyncio.sleep(random.random())
+        await sleep(rand())
 
 
-async def shutdown(signal, loop):
+async def shutdown(signal):
     """Cleanup tasks tied to the serivces's shutdown"""
-    logging.info(f"Recieved exit signal {signal.name}...")
-    logging.info("Closing database connections")
-    logging.info("Nacking outstanding messages")
+    log.info("Recieved exit signal %s...", signal.name)
+    log.info("Closing database connections")
+    log.info("Nacking outstanding messages")
     tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     [task.cancel() for task in tasks]
 
-    logging.info(f"Cancelling {len(tasks)} outstanding tasks")
+    log.info("Cancelling %d outstanding tasks", len(tasks))
     await asyncio.gather(*tasks, return_exceptions=True)
-    logging.info("Flushing metrics")
-    loop.stop()
+    log.info("Flushing metrics")
 
 
-def main():
-    loop = asyncio.get_event_loop()
+def setup_logging():
+    """
+    Route log records through a queue so that emitting them never blocks the event loop.
 
-    signals = [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]
+    returns:
+        logging.handlers.QueueListener: running listener writing records to stderr from its own thread.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        fmt="%(asctime)s,%(msecs)d %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+    ))
+    log_queue = SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+async def amain():
+    """Run the publisher and consumers until an exit signal is received."""
+    loop = asyncio.get_running_loop()
+    received = loop.create_future()
+
+    def on_signal(s):
+        # only the first signal triggers a shutdown
+        if not received.done():
+            received.set_result(s)
 
+    signals = [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]
     for s in signals:
-        loop.add_signal_handler(
-            s,
-            lambda s=s: asyncio.create_task(shutdown(s, loop))
-        )
+        loop.add_signal_handler(s, on_signal, s)
 
-    queue = asyncio.Queue()
+    queue = MessageQueue(maxsize=QUEUE_MAXSIZE)
+    asyncio.create_task(publish(queue))
+    for _ in range(WORKERS):
+        asyncio.create_task(consume(queue))
+
+    await shutdown(await received)
+
+
+def main():
+    listener = setup_logging()
+    # uvloop.run picks the loop through asyncio.run's loop_factory where available,
+    # avoiding the deprecated event loop policy APIs
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        loop.create_task(publish(queue))
-        loop.create_task(consume(queue))
-        loop.run_forever()
+        run(amain())
     finally:
-        loop.close()
-        logging.info("Successfully shutdown the Mayhem service.")
+        log.info("Successfully shutdown the Mayhem service.")
+        listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,124 @@
+import asyncio
+import logging
+
+import pytest
+
 from mayhem_mandrill import __version__
+from mayhem_mandrill import mayhem
+from mayhem_mandrill.mayhem import HOST_ID_CHARS, MessageQueue, PubSubMessage, _generate_host_ids
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_message_queue_is_fifo():
+    async def run():
+        queue = MessageQueue()
+        for i in range(3):
+            queue.put_nowait(i)
+        return [await queue.get() for _ in range(3)]
+
+    assert asyncio.run(run()) == [0, 1, 2]
+
+
+def test_message_queue_get_waits_for_put():
+    async def run():
+        queue = MessageQueue()
+        getter = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        queue.put_nowait("msg")
+        return await asyncio.wait_for(getter, 1)
+
+    assert asyncio.run(run()) == "msg"
+
+
+def test_message_queue_put_nowait_raises_when_full():
+    async def run():
+        queue = MessageQueue(maxsize=2)
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        assert queue.full()
+        with pytest.raises(asyncio.QueueFull):
+            queue.put_nowait(3)
+
+    asyncio.run(run())
+
+
+def test_message_queue_put_waits_for_room():
+    async def run():
+        queue = MessageQueue(maxsize=1)
+        queue.put_nowait(1)
+        putter = asyncio.create_task(queue.put(2))
+        await asyncio.sleep(0)
+        assert not putter.done()
+        assert await queue.get() == 1
+        await asyncio.wait_for(putter, 1)
+        return await queue.get()
+
+    assert asyncio.run(run()) == 2
+
+
+def test_message_queue_concurrent_consumers_get_distinct_items():
+    async def run():
+        queue = MessageQueue()
+        getters = [asyncio.create_task(queue.get()) for _ in range(4)]
+        await asyncio.sleep(0)
+        for i in range(4):
+            queue.put_nowait(i)
+        return await asyncio.wait_for(asyncio.gather(*getters), 1)
+
+    assert sorted(asyncio.run(run())) == [0, 1, 2, 3]
+
+
+def test_generate_host_ids():
+    host_ids = _generate_host_ids(256)
+    assert len(host_ids) == 256
+    for host_id in host_ids:
+        assert len(host_id) == 4
+        assert set(host_id) <= set(HOST_ID_CHARS)
+
+
+def test_consume_survives_failed_message(monkeypatch, caplog):
+    extend_events = []
+
+    async def save(msg):
+        if msg.instance_name == "cattle-bad":
+            raise RuntimeError("database unavailable")
+        msg.saved = True
+
+    async def restart_host(msg):
+        msg.restarted = True
+
+    async def extend(msg, event):
+        extend_events.append(event)
+
+    monkeypatch.setattr(mayhem, "save", save)
+    monkeypatch.setattr(mayhem, "restart_host", restart_host)
+    monkeypatch.setattr(mayhem, "extend", extend)
+
+    bad = PubSubMessage("cattle-bad", "1", "cattle-bad.example.net")
+    good = PubSubMessage("cattle-good", "2", "cattle-good.example.net")
+
+    async def run():
+        queue = MessageQueue()
+        queue.put_nowait(bad)
+        queue.put_nowait(good)
+        consumer = asyncio.create_task(mayhem.consume(queue))
+        for _ in range(100):
+            if good.acked:
+                break
+            await asyncio.sleep(0)
+        assert not consumer.done()
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+
+    with caplog.at_level(logging.ERROR, logger=mayhem.log.name):
+        asyncio.run(run())
+
+    assert not bad.acked
+    assert good.acked
+    assert len(extend_events) == 2
+    assert all(event.is_set() for event in extend_events)
+    assert "Error handling PubSubMessage(instance_name='cattle-bad')" in caplog.text